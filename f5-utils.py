@@ -1,57 +1,280 @@
 import os
+import re
+import sys
+import json
+import atexit
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from splinter import Browser
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 from securid.stoken import StokenFile
 import time
 
-def get_session(url, username):
-    # Remove any existing HTTP or HTTPS proxy environment variables from the os.environ dictionary
-    if 'http_proxy' in os.environ or 'https_proxy' in os.environ:
-        os.environ.pop('http_proxy', None)
-        os.environ.pop('https_proxy', None)
-    
-    # Retrieve a SecurID token using the securid library
-    stoken = StokenFile()
-    token = stoken.get_token()
+# Remove any existing HTTP or HTTPS proxy environment variables from the os.environ dictionary,
+# once for the whole process since parallel logins share it
+for k in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'):
+    os.environ.pop(k, None)
 
+# Resources the login page doesn't need, blocked via CDP to cut round trips
+BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg',
+    '*.woff*', '*.ttf', '*.css',
+    '*googletagmanager*', '*google-analytics*', '*doubleclick*',
+]
+
+PROFILE_DIR = '/home/kj54321/Downloads/chrome_auto_profile'
+
+# Selenium Grid hub used by get_sessions
+GRID_URL = 'http://grid:4444/wd/hub'
+
+# Hidden inputs of the logon form, passed through by get_session_http
+HIDDEN_INPUT_RE = re.compile(r'<input[^>]*type="hidden"[^>]*name="([^"]+)"[^>]*value="([^"]*)"')
+
+_BROWSER = None
+_BROWSER_LOCK = threading.Lock()
+
+SESSION_CACHE = os.path.expanduser('~/.cache/f5vpn/session.json')
+
+def load_cached_session(url):
+    # Return the cached MRHSession if the server still accepts it, otherwise None
+    try:
+        with open(SESSION_CACHE) as f:
+            cached = json.load(f).get('MRHSession')
+    except (OSError, ValueError):
+        return None
+    if not cached or not session_is_valid(url, cached):
+        return None
+    return cached
+
+def session_is_valid(url, MRHSession):
+    # Same check as f5vpn-login.py: an expired session gets redirected to the logon page
+    try:
+        r = requests.get(url.rstrip('/') + '/vdesk/vpn/index.php3?outform=xml',
+                         cookies={'MRHSession': MRHSession}, allow_redirects=False, timeout=5)
+    except requests.RequestException:
+        return False
+    return r.status_code == 200 and '/my.logon.php3' not in r.headers.get('Location', '')
+
+def save_session(MRHSession):
+    try:
+        os.makedirs(os.path.dirname(SESSION_CACHE), exist_ok=True)
+        fd = os.open(SESSION_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'MRHSession': MRHSession, 'ts': int(time.time())}, f)
+    except OSError:
+        print("Couldn't write session cache: %s" % SESSION_CACHE)
+
+@functools.lru_cache(maxsize=None)
+def get_token(stoken_file=None):
+    # Read and parse each stoken file once per process, not on every login.
+    # None is the default ~/.stokenrc.
+    if stoken_file is None:
+        return StokenFile().get_token()
+    return StokenFile(stoken_file).get_token()
+
+# Built once per profile directory, the options never change between logins
+@functools.lru_cache(maxsize=None)
+def make_chrome_options(profile_dir=PROFILE_DIR):
     # Create a webdriver.ChromeOptions object and set the --user-data-dir option to a specific directory
     chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument('--user-data-dir=/home/kj54321/Downloads/chrome_auto_profile')
+    chrome_options.add_argument('--user-data-dir=%s' % profile_dir)
+
+    # Run Chrome headless, nobody looks at the login page anyway
+    chrome_options.add_argument('--headless=new')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--window-size=1280,1024')
+
+    # Strip background services the reused profile would otherwise start
+    chrome_options.add_argument('--disable-extensions')
+    chrome_options.add_argument('--disable-background-networking')
+    chrome_options.add_argument('--disable-sync')
+    chrome_options.add_argument('--disable-default-apps')
+    chrome_options.add_argument('--disable-component-update')
+    chrome_options.add_argument('--disable-features=TranslateUI,MediaRouter,OptimizationHints')
+    chrome_options.add_argument('--no-first-run')
+    chrome_options.add_argument('--no-default-browser-check')
+    chrome_options.add_argument('--metrics-recording-only')
+    chrome_options.add_argument('--safebrowsing-disable-auto-update')
+    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+
+    # Don't load images at the profile level either
+    chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+
+    # Return from visit() at DOMContentLoaded, the explicit waits take it from there
+    chrome_options.page_load_strategy = 'eager'
+    return chrome_options
+
+def setup_browser(browser):
+    # Block images, fonts, stylesheets and trackers before loading anything.
+    # Plain remote drivers don't speak CDP, those just load everything.
+    if not hasattr(browser.driver, 'execute_cdp_cmd'):
+        return browser
+    browser.driver.execute_cdp_cmd('Network.enable', {})
+    browser.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+    # Make sure the HTTP cache of the persistent profile is used
+    browser.driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled': False})
+    return browser
+
+def get_session_http(url, username, totp):
+    # Log in with a plain form POST to /my.policy, no browser involved.
+    # Returns None when the server wants something we can't do this way (e.g. a captcha).
+    url = url.rstrip('/')
+    with requests.Session() as session:
+        try:
+            # Pick up the initial session cookie and any hidden inputs of the logon form
+            r = session.get(url, timeout=10)
+            data = dict(HIDDEN_INPUT_RE.findall(r.text))
+            data.update({'username': username, 'password': totp, 'vhost': 'standard'})
+            session.post(url + '/my.policy', data=data, headers={'Referer': url + '/my.logon.php3'}, timeout=10)
+        except requests.RequestException:
+            return None
+        MRHSession = session.cookies.get('MRHSession')
+    if not MRHSession or not session_is_valid(url, MRHSession):
+        return None
+    return MRHSession
+
+def get_browser():
+    # Chrome is started once and reused by every get_session call in this process
+    global _BROWSER
+    with _BROWSER_LOCK:
+        if _BROWSER is None:
+            # Use the Browser class from the splinter library to create a new Chrome browser instance with the specified options
+            _BROWSER = setup_browser(Browser('chrome', options=make_chrome_options()))
+            atexit.register(_BROWSER.quit)
+        return _BROWSER
+
+def get_remote_browser(profile_dir, command_executor=GRID_URL):
+    # A Chrome instance on the Selenium Grid, one per parallel login
+    return setup_browser(Browser('remote', browser='chrome', command_executor=command_executor,
+                                 options=make_chrome_options(profile_dir)))
 
-    # Use the Browser class from the splinter library to create a new Chrome browser instance with the specified options
-    with Browser('chrome', options=chrome_options) as browser:
+def fill(element, text):
+    # Unlike splinter's fill, send the whole string in a single Selenium command
+    element.clear()
+    element.send_keys(text)
+
+def check_pin(pin):
+    if not isinstance(pin, int) or not 0 <= pin <= 99999999:
+        raise ValueError("SecurID pin must be a number of up to 8 digits")
+
+def get_totp(pin, stoken_file=None):
+    # Fail before any network or Selenium work if the token file is broken
+    try:
+        return get_token(stoken_file).now(pin=pin)
+    except Exception as e:
+        raise Exception("Couldn't compute SecurID token code: %s" % e)
+
+def get_next_totp(pin, stoken_file=None):
+    # A tokencode the server has already seen is rejected as a replay, so wait for the next one
+    wait = get_token(stoken_file).time_left()
+    print("Waiting %d seconds for the next tokencode..." % wait)
+    time.sleep(wait)
+    return get_totp(pin, stoken_file)
+
+def browser_login(browser, url, username, totp):
+    # Talk to Selenium directly, the splinter wrappers only add round trips
+    drv = browser.driver
+
+    # Start every login from a clean slate, a reused browser still holds the last MRHSession
+    if hasattr(drv, 'execute_cdp_cmd'):
+        drv.execute_cdp_cmd('Network.clearBrowserCookies', {})
         # Navigate to a URL using the visit method of the Browser object
         browser.visit(url)
+    else:
+        # Without CDP only the cookies of the current page can be dropped, so visit the host first
+        browser.visit(url)
+        browser.cookies.delete_all()
+        browser.visit(url)
+    wait = WebDriverWait(drv, 15, poll_frequency=0.1)
+
+    # Click a link on the web page that contains the text "accept this policy"
+    wait.until(EC.presence_of_element_located((By.PARTIAL_LINK_TEXT, "accept this policy"))).click()
+
+    # Wait for the username and password inputs to show up, and fill in a username and a SecurID token code
+    fill(wait.until(EC.presence_of_element_located((By.NAME, "username"))), username)
+    fill(wait.until(EC.presence_of_element_located((By.NAME, "password"))), totp)
+    # Click a button with the value "Logon"
+    drv.find_element(By.CSS_SELECTOR, "input[value='Logon']").click()
 
-        # Click a link on the web page that contains the text "accept this policy"
-        browser.links.find_by_partial_text('accept this policy').click()
-
-        # Find a form input element by its name attribute, fill in a username, and find another form input element by its name attribute and fill in a SecurID token code
-        browser.is_text_present('username')
-        #time.sleep(20)
-        element = browser.find_by_name('username')
-        element.fill(username)
-        element = browser.find_by_name('password')
-        element.fill(token.now(pin=XXXX))
-        # Click a button with the value "Logon"
-        browser.find_by_value('Logon').click()
-
-        # Check if an element containing the text "Network access client components are required." is present on the page
-        if browser.is_element_present_by_text("Network access client components are required.", wait_time=25):
-            # If it is, retrieve the value of a cookie called MRHSession
-            cookies = browser.cookies.all()
-            MRHSession = cookies.get('MRHSession')
-        else:
-            # If the element containing the text "Network access client components are required." is not present, raise an error
-            raise Exception("Oops, something went wrong.")
-
-        # Return the value of MRHSession
+    # Wait until the text "Network access client components are required." is present on the page
+    try:
+        WebDriverWait(drv, 25, poll_frequency=0.2).until(
+            EC.text_to_be_present_in_element((By.TAG_NAME, "body"), "Network access client components are required."))
+    except TimeoutException:
+        # If the text never shows up, raise an error
+        raise Exception("Oops, something went wrong.")
+
+    # Retrieve the value of a cookie called MRHSession, without dumping the whole cookie jar
+    cookie = drv.get_cookie('MRHSession')
+    if cookie is None:
+        raise Exception("Oops, no MRHSession cookie.")
+    return cookie['value']
+
+def get_session(url, username, pin, browser=None, stoken_file=None):
+    check_pin(pin)
+
+    # Without an explicit browser, use the shared local one and the session cache
+    if browser is not None:
+        return browser_login(browser, url, username, get_totp(pin, stoken_file))
+
+    # Skip the browser entirely if the last session is still alive
+    MRHSession = load_cached_session(url)
+    if MRHSession is not None:
         return MRHSession
 
+    totp = get_totp(pin, stoken_file)
+
+    # Try the browserless login first, Chrome is only the fallback
+    MRHSession = get_session_http(url, username, totp)
+    if MRHSession is None:
+        # The POST may have burnt this tokencode already, don't send it twice
+        MRHSession = browser_login(get_browser(), url, username, get_next_totp(pin, stoken_file))
+    save_session(MRHSession)
+
+    # Return the value of MRHSession
+    return MRHSession
+
+def _get_session_remote(url, username, pin, stoken_file, profile_dir):
+    browser = get_remote_browser(profile_dir)
+    try:
+        return get_session(url, username, pin, browser, stoken_file)
+    finally:
+        browser.quit()
+
+def get_sessions(jobs, max_workers=4):
+    # Log in to several (url, username, pin, stoken_file) jobs in parallel on the Selenium Grid,
+    # returning the MRHSession values in the same order as jobs.
+    # Each job needs its own token: running at the same time, jobs sharing one
+    # would all send the same tokencode and all but the first get rejected as replays.
+    stoken_files = [os.path.expanduser(stoken_file) if stoken_file else None
+                    for url, username, pin, stoken_file in jobs]
+    if len(set(stoken_files)) != len(stoken_files):
+        raise ValueError("Every parallel login needs its own stoken file")
+    for url, username, pin, stoken_file in jobs:
+        check_pin(pin)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_get_session_remote, url, username, pin, stoken_file, '%s-%d' % (PROFILE_DIR, i))
+                   for i, ((url, username, pin, _), stoken_file) in enumerate(zip(jobs, stoken_files))]
+        return [future.result() for future in futures]
+
 if __name__ == '__main__':
     url = 'https://yourcompany.com'
     username = 'yourusername'
-    session = get_session(url, username)
+    # 2FA pin from the command line or the STOKEN_PIN environment variable
+    pin = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('STOKEN_PIN')
+    if pin is None or not pin.isdigit():
+        sys.stderr.write("Usage: %s [pin] (or set STOKEN_PIN)\n" % sys.argv[0])
+        sys.exit(1)
+    session = get_session(url, username, int(pin))
     print("Writing session "+session)
 
 
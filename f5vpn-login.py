@@ -7,18 +7,25 @@ Works with OSX and Linux
 TODO: verify server certificate. (requires using pyopenssl instead of
 socket.ssl)
 """
-import socket, re, sys, os, time, fcntl, select, errno, signal
-import getpass, getopt, types
+import socket, re, sys, os, time, fcntl, selectors, errno, signal
+import getpass, getopt, types, functools, struct, subprocess, itertools
+import json
+import threading
 import string
 import ssl
+from xml.etree import ElementTree
 import time
-from ssl import wrap_socket
 
 try:
     import socks
 except ImportError:
     socks = None
 
+try:
+    from pyroute2 import IPRoute, NetlinkError
+except ImportError:
+    IPRoute = NetlinkError = None
+
 PPPD_PATH = "/usr/sbin/pppd"
 
 CONFIG_FILE = "~/.f5vpn-login.conf"
@@ -27,6 +34,14 @@ KEEPALIVE_TIMEOUT = 60 * 10
 
 BUF_SIZE = 8192
 
+RTMGRP_LINK = 1 # netlink multicast group for link state changes
+
+# Seconds to wait on a login server connection before giving it up for dead
+HTTP_TIMEOUT = 15
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFF_UP = 0x1
+
 proxy_addr = None
 
 current_time = int(time.time())
@@ -36,6 +51,29 @@ ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
 ssl_context.check_hostname = False # ignore hostname check
 ssl_context.verify_mode = ssl.CERT_NONE # ignore cert check
 ssl_context.min_version = ssl.TLSVersion.TLSv1_2
+ssl_context.maximum_version = ssl.TLSVersion.TLSv1_3 # 1-RTT handshakes where the server supports it
+ssl_context.options |= ssl.OP_NO_COMPRESSION
+ssl_context.options &= ~ssl.OP_NO_TICKET # session tickets are what makes resumption work
+# Let OpenSSL hand record encryption to the kernel (kTLS) where it can
+# (Python 3.12+, OpenSSL 3 and the Linux tls module); it falls back to
+# userspace crypto by itself otherwise.
+ssl_context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+
+# Patterns used to pick apart the server's responses during login
+_RE_CLIENT_DATA1 = re.compile(r'document\.external_data_post_cls\.client_data\.value = "([\w=]+)"')
+_RE_CLIENT_DATA2 = re.compile(r'name="client_data" value="([\w=]+)"')
+_RE_SESSION = re.compile(r'^Set-Cookie: MRHSession=([^;]*);', re.MULTILINE)
+_RE_CHALLENGE = re.compile(r'(Challenge: [^<]*)')
+_RE_HTTP_302 = re.compile(r'HTTP/[0-9.]+ 302( Found)?')
+_RE_Z_PARAM = re.compile(r'Z=(\S+,\S+)&')
+_RE_EMBED = re.compile(r'<embed [^>]*?(version=[^>]*)>')
+_RE_EMBED_JS = re.compile(r"document\.writeln\('(version=[^)]*)'\)")
+_RE_XML_FAV = re.compile(r'<\?xml.*<favorite.*<object\s+ID="ur_Host".+?</favorite>', re.DOTALL)
+_RE_LOCATION_LOGIN = re.compile(r'^Location: /my\.logon\.php3', re.MULTILINE)
+_RE_Q_PARAM = re.compile(r'q[0-9]+')
+
+# w[.x[.y[.z]]], optionally followed by /numbits or /A.B.C.D
+_RE_ROUTESPEC = re.compile(r'^(?P<net>\d+(?:\.\d+){0,3})(?:/(?:(?P<bits>\d+)|(?P<mask>\d+(?:\.\d+){1,3})))?$')
 
 def set_non_blocking(fd):
     flags = fcntl.fcntl(fd, fcntl.F_GETFL)
@@ -68,7 +106,28 @@ def run_as_root(args, stdin=None):
     else:
         pipe_r, pipe_w = None, None
 
-    pid = os.fork()
+    if os.getuid() == 0:
+        # Real uid is root already (e.g. run via sudo), so the child's
+        # setuid(0) below would be a no-op: use posix_spawn, which skips
+        # copying the whole interpreter's page tables just to exec.
+        file_actions = []
+        if pipe_r is not None:
+            # setup stdin pipe
+            file_actions = [(os.POSIX_SPAWN_DUP2, pipe_r, 0),
+                            (os.POSIX_SPAWN_CLOSE, pipe_r),
+                            (os.POSIX_SPAWN_CLOSE, pipe_w)]
+        try:
+            pid = as_root(os.posix_spawn, args[0], args, os.environ, file_actions=file_actions)
+        except OSError as e:
+            # posix_spawn reports a failed exec here rather than in a child:
+            # clean up and fail the same way the fork path does.
+            if pipe_r is not None:
+                os.close(pipe_r)
+                os.close(pipe_w)
+            sys.stderr.write("Couldn't exec %s: %s\n" % (args[0], e))
+            raise Exception("%r: exited with result %d" % (args, 127))
+    else:
+        pid = os.fork()
     if pid == 0:
         if pipe_r is not None:
             # setup stdin pipe
@@ -81,6 +140,7 @@ def run_as_root(args, stdin=None):
         try:
             os.execv(args[0], args)
         except:
+            os.write(2, ("Couldn't exec %s: %s\n" % (args[0], sys.exc_info()[1])).encode('utf-8', 'replace'))
             os._exit(127)
     else:
         if pipe_r is not None:
@@ -121,7 +181,7 @@ class DummyPlatform:
     def setup_dns(iface_name, service_id, dns_servers, dns_domains, revdns_domains, override_gateway):
         print(
             "setup_dns(iface_name=%r, service_id=%r, dns_servers=%r, dns_domains=%r, revdns_domains=%r, override_gateway=%r)" % (
-                iface_name, service_id, dns_servers, dns_domains, revdns_domains, override_gateway))
+                iface_name, service_id, dns_servers, dns_domains, list(revdns_domains), override_gateway))
 
     @staticmethod
     def teardown_dns():
@@ -202,7 +262,7 @@ class DarwinPlatform(Platform):
                 if override_gateway:
                     d[u'SearchDomains'] = dns_domains
                 else:
-                    d[u'SupplementalMatchDomains'] = dns_domains + revdns_domains
+                    d[u'SupplementalMatchDomains'] = dns_domains + list(revdns_domains)
                 SystemConfiguration.SCDynamicStoreSetValue(sc, 'State:/Network/Service/%s/DNS' % service_id, d)
 
             as_root(setup_helper)
@@ -212,28 +272,94 @@ class LinuxPlatform(Platform):
     def __init__(self):
         self.ifconfig_path = '/sbin/ifconfig'
 
+    @staticmethod
+    def _open_link_monitor():
+        # Netlink socket that gets a message on every link state change, so
+        # we don't have to sleep blindly between checks.
+        try:
+            nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            nl.bind((0, RTMGRP_LINK))
+        except (OSError, AttributeError):
+            return None
+        nl.settimeout(5)
+        return nl
+
+    @staticmethod
+    def _link_ready(iface_name):
+        # ppp links report operstate 'unknown' for good, so look at the flags
+        # instead: administratively up, with the carrier (lower layer) up too.
+        try:
+            with open('/sys/class/net/%s/flags' % iface_name) as f:
+                flags = int(f.read(), 16)
+            with open('/sys/class/net/%s/carrier' % iface_name) as f:
+                carrier = f.read().strip() == '1'
+        except (IOError, ValueError):
+            # reading carrier fails with EINVAL while the link is down
+            return False
+        return bool(flags & IFF_UP) and carrier
+
+    @staticmethod
+    def _wait_link_change(nl, iface_name, timeout):
+        # Wait until the kernel reports a change to iface_name (to any link,
+        # while it doesn't exist yet), or until timeout seconds have passed.
+        try:
+            with open('/sys/class/net/%s/ifindex' % iface_name) as f:
+                ifindex = int(f.read())
+        except (IOError, ValueError):
+            ifindex = None
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            nl.settimeout(remaining)
+            try:
+                data = nl.recv(BUF_SIZE)
+            except socket.timeout:
+                return
+            # nlmsghdr (16 bytes) followed by ifinfomsg, with ifi_index at offset 4
+            off = 0
+            while off + 24 <= len(data):
+                length, msg_type = struct.unpack_from('=IH', data, off)
+                if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                    index, = struct.unpack_from('=i', data, off + 20)
+                    if ifindex is None or index == ifindex:
+                        return
+                if length < 16:
+                    break
+                off += (length + 3) & ~3
+
     def wait_for_interface(self, iface_name):
         iface_up = False
         already_unknown = False
+        nl = self._open_link_monitor()
         while not iface_up:
             try:
                 state_file = open('/sys/class/net/%s/operstate' % iface_name)
                 state = str.strip(state_file.read())
+                state_file.close()
                 if state == 'up':
                     iface_up = True
                     continue
                 elif state == 'unknown':
-                    if already_unknown:
+                    if already_unknown or self._link_ready(iface_name):
                         iface_up = True
                         continue
                     already_unknown = True
-                    print('Status of interface %s is unknown. Waiting 5 seconds...' % iface_name)
+                    print('Status of interface %s is unknown. Waiting up to 5 seconds...' % iface_name)
                 else:
                     already_unknown = True
-                    print('Interface %s is not up yet. Waiting 5 seconds...' % iface_name)
+                    print('Interface %s is not up yet. Waiting up to 5 seconds...' % iface_name)
             except IOError:
-                print('Interface %s does not exist yet. Waiting 5 seconds...' % iface_name)
-            time.sleep(5)
+                print('Interface %s does not exist yet. Waiting up to 5 seconds...' % iface_name)
+            if nl is None:
+                time.sleep(5)
+            else:
+                # Wake up early when the link changes and look again
+                self._wait_link_change(nl, iface_name, 5)
+        if nl is not None:
+            nl.close()
 
         print('Interface %s is up!' % iface_name)
 
@@ -254,18 +380,21 @@ class ManualFrobbingDNSMixin:
         if override_gateway:
             old_resolv_conf = []
         else:
-            old_resolv_conf = open("/etc/resolv.conf").readlines()
+            with open("/etc/resolv.conf") as f:
+                old_resolv_conf = f.read().splitlines()
 
         other_lines = []
         search = ''
         nses = []
         for line in old_resolv_conf:
-            line = line.rstrip('\n')
-            if line.startswith('search ') or line.startswith('domain '):
+            key, sep, rest = line.partition(' ')
+            if not sep:
+                other_lines.append(line)
+            elif key in ('search', 'domain'):
                 # domain entry is simply an alternative spelling for search
-                search = line.split(' ', 1)[1]
-            elif line.startswith('nameserver '):
-                nses.append(line.split(' ', 1)[1])
+                search = rest
+            elif key == 'nameserver':
+                nses.append(rest)
             else:
                 other_lines.append(line)
 
@@ -369,17 +498,9 @@ def get_platform():
 platform = get_platform()
 
 
-def readline_from_sock(s):
-    output = ''
-    while 1:
-        data = s.recv(1)
-        if not data:
-            break
-        elif data == '\n':
-            break
-        elif data != '\r':
-            output += data
-    return output
+def readline_from_sock(f):
+    # f is a buffered file from s.makefile('rb'), so this doesn't recv() byte by byte
+    return f.readline().rstrip(b'\r\n').decode('latin-1')
 
 
 def proxy_connect(ip, port):
@@ -388,14 +509,16 @@ def proxy_connect(ip, port):
     if proxy_addr and proxy_addr[0] == 'http':
         s = socket.socket()
         s.connect(proxy_addr[1:])
-        s.send("CONNECT %s:%d HTTP/1.0\r\n\r\n" % (ip, port))
-        statusline = readline_from_sock(s).split(' ')
+        s.send(("CONNECT %s:%d HTTP/1.0\r\n\r\n" % (ip, port)).encode('utf-8'))
+        f = s.makefile('rb', buffering=BUF_SIZE)
+        statusline = readline_from_sock(f).split(' ')
         if len(statusline) < 2 or statusline[1] != '200':
             raise Exception("Proxy returned bad status for CONNECT: %r" % ' '.join(statusline))
         while 1:  # Read remaining headers, if any
-            line = readline_from_sock(s)
+            line = readline_from_sock(f)
             if line == '':
                 break
+        f.close()
         # Now the ssl connection is going
     elif proxy_addr and proxy_addr[0] == 'socks5':
         # Socks method
@@ -408,6 +531,12 @@ def proxy_connect(ip, port):
     return s
 
 
+@functools.lru_cache(maxsize=128)
+def resolve(host):
+    # Every login request goes to the same host; only look it up once.
+    return socket.gethostbyname(host)
+
+
 def parse_hostport(host, default_port=0):
     ipport = host.split(':')
     if len(ipport) == 1:
@@ -416,28 +545,204 @@ def parse_hostport(host, default_port=0):
     else:
         ip = ipport[0]
         port = int(ipport[1])
-    ip = socket.gethostbyname(ip)
+    ip = resolve(ip)
     return ip, port
 
 
-def send_request(host, request):
+def read_http_response(ssl_socket):
+    """Read one HTTP response off ssl_socket. Returns (response, keep_alive),
+    where response is the raw header followed by the (de-chunked) body."""
+    buf = bytearray()
+
+    def fill():
+        try:
+            chunk = ssl_socket.read(BUF_SIZE)
+        except (socket.error, ssl.SSLError):
+            chunk = b''
+        buf.extend(chunk)
+        return len(chunk)
+
+    while b'\r\n\r\n' not in buf:
+        if not fill():
+            return bytes(buf), False
+    header_end = buf.index(b'\r\n\r\n') + 4
+    header = bytes(buf[:header_end])
+
+    headers = {}
+    header_lines = header.decode('latin-1').split('\r\n')
+    for line in header_lines[1:]:
+        k, _, v = line.partition(':')
+        headers[k.strip().lower()] = v.strip().lower()
+    keep_alive = header_lines[0].startswith('HTTP/1.1') and headers.get('connection') != 'close'
+
+    # These never have a body, whatever the headers say
+    status = header_lines[0].split(' ', 2)[1:2]
+    if status and (status[0].startswith('1') or status[0] in ('204', '304')):
+        return header, keep_alive
+
+    if 'chunked' in headers.get('transfer-encoding', ''):
+        body = bytearray()
+        pos = header_end
+        while 1:
+            while b'\r\n' not in buf[pos:]:
+                if not fill():
+                    return header + bytes(body), False
+            line_end = buf.index(b'\r\n', pos)
+            size = int(bytes(buf[pos:line_end]).split(b';')[0], 16)
+            pos = line_end + 2
+            if size == 0:
+                break
+            while len(buf) < pos + size + 2:
+                if not fill():
+                    return header + bytes(body) + bytes(buf[pos:]), False
+            body += buf[pos:pos + size]
+            pos += size + 2
+        # Skip (ignore) any trailers, up to the final empty line
+        while 1:
+            while b'\r\n' not in buf[pos:]:
+                if not fill():
+                    return header + bytes(body), False
+            line_end = buf.index(b'\r\n', pos)
+            if line_end == pos:
+                break
+            pos = line_end + 2
+        return header + bytes(body), keep_alive
+
+    if 'content-length' in headers:
+        end = header_end + int(headers['content-length'])
+        while len(buf) < end:
+            if not fill():
+                return bytes(buf), False
+        return bytes(buf[:end]), keep_alive
+
+    # No length given: the body runs until the server closes the connection
+    while fill():
+        pass
+    return bytes(buf), False
+
+
+# Open keep-alive connections, by host
+_conn_cache = {}
+
+# Last TLS session seen for each host, offered again on the next connection
+# so the server can resume it instead of doing a full handshake.
+_tls_sessions = {}
+
+
+def wrap_tls_socket(s, host):
+    return ssl_context.wrap_socket(s, server_hostname=host, session=_tls_sessions.get(host))
+
+
+def save_tls_session(ssl_socket, host):
+    if ssl_socket.session is not None:
+        _tls_sessions[host] = ssl_socket.session
+
+
+def open_connection(host):
     ip, port = parse_hostport(host, 443)
-    s = proxy_connect(ip, port)
-    ssl_socket = ssl_context.wrap_socket(s, server_hostname=host)
-    ssl_socket.write(request.encode('utf-8'))
-    data = ''.encode('utf-8')
     while 1:
+        s = proxy_connect(ip, port)
+        # A read timing out shows up as an empty response, so a connection that
+        # went away silently while pooled is dropped and replaced.
+        s.settimeout(HTTP_TIMEOUT)
         try:
-            bytes = ssl_socket.read(1)
-            if len(bytes) == 0:
-                break
-            data += bytes
+            return wrap_tls_socket(s, host)
+        except ssl.SSLCertVerificationError:
+            s.close()
+            raise
+        except (ssl.SSLError, ConnectionResetError) as e:
+            s.close()
+            # Some old servers choke on a TLS 1.3 ClientHello instead of
+            # negotiating down (an alert, a reset or just EOF); stick to
+            # TLS 1.2 for the rest of the run.
+            if ssl_context.maximum_version == ssl.TLSVersion.TLSv1_2:
+                raise
+            sys.stderr.write("TLS 1.3 handshake failed (%s), retrying with TLS 1.2\n" % e)
+            ssl_context.maximum_version = ssl.TLSVersion.TLSv1_2
+
+
+def send_request(host, request):
+    data = b''
+    ssl_socket = _conn_cache.pop(host, None)
+    if ssl_socket is not None:
+        # Reuse the connection from the last request; the server may have
+        # dropped it in the meantime, in which case try a fresh one below.
+        try:
+            ssl_socket.write(request)
+            data, keep_alive = read_http_response(ssl_socket)
         except (socket.error, ssl.SSLError):
-            break
+            pass
+        if not data:
+            ssl_socket.close()
+
+    if not data:
+        ssl_socket = open_connection(host)
+        ssl_socket.write(request)
+        data, keep_alive = read_http_response(ssl_socket)
+
+    # With TLS 1.3 the ticket only arrives after the handshake, so pick the
+    # session up once the response has been read.
+    save_tls_session(ssl_socket, host)
+
+    if keep_alive and b'\r\nConnection: close\r\n' not in request:
+        _conn_cache[host] = ssl_socket
+    else:
+        ssl_socket.close()
     # print data
     return data.decode('utf-8')
 
 
+# Kept as bytes: only the variable fields get encoded per request.
+REQUEST_TEMPLATE = b"""%(method)b %(path)b HTTP/1.1\r
+Accept: */*\r
+Accept-Language: en\r
+Cookie: %(cookie)b\r
+Referer: https://%(host)b%(referer)b\r
+User-Agent: Mozilla/5.0 (Macintosh; U; PPC Mac OS X; en) AppleWebKit/417.9 (KHTML, like Gecko) Safari/417.9.2\r
+Host: %(host)b\r
+Connection: %(connection)b\r
+%(extra)b\r
+%(body)b"""
+
+POST_HEADERS_TEMPLATE = b"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: %d\r\n"
+
+
+def make_request(host, method, path, cookie, referer, body=None, connection='keep-alive'):
+    # Build one of the login requests; they only differ in these few fields.
+    if body is None:
+        body = extra = b''
+    else:
+        body = body.encode('utf-8')
+        extra = POST_HEADERS_TEMPLATE % len(body)
+    return REQUEST_TEMPLATE % {b'method': method.encode('ascii'), b'path': path.encode('utf-8'),
+                               b'cookie': cookie.encode('utf-8'), b'host': host.encode('utf-8'),
+                               b'referer': referer.encode('utf-8'), b'connection': connection.encode('ascii'),
+                               b'extra': extra, b'body': body}
+
+
+def run_in_background(fn, *args):
+    # Start fn(*args) on a daemon thread, so a Ctrl-C doesn't have to wait for
+    # it, and return a function that waits for its result (or raises its error).
+    result = []
+
+    def run():
+        try:
+            result.append((True, fn(*args)))
+        except BaseException as e:
+            result.append((False, e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    def get():
+        thread.join()
+        ok, value = result[0]
+        if not ok:
+            raise value
+        return value
+    return get
+
+
 def get_vpn_client_data(host):
     # Some FirePass servers are configured to redirect to an external "pre-login
     # check" server.  This server is supposed to run some random additional
@@ -447,50 +752,33 @@ def get_vpn_client_data(host):
     # If such an element is present, the firepass will refuse login unless we
     # pass it through to the my.activation.php3 script. So, do so. Secureetay!
 
-    request = """GET /my.logon.php3?check=1 HTTP/1.0\r
-Accept: */*\r
-Accept-Language: en\r
-Cookie: uRoamTestCookie=TEST; VHOST=standard\r
-Referer: https://%(host)s/my.activation.php3\r
-User-Agent: Mozilla/5.0 (Macintosh; U; PPC Mac OS X; en) AppleWebKit/417.9 (KHTML, like Gecko) Safari/417.9.2\r
-Host: %(host)s\r
-\r
-""" % dict(host=host)
+    request = make_request(host, 'GET', '/my.logon.php3?check=1',
+                           'uRoamTestCookie=TEST; VHOST=standard', '/my.activation.php3')
     result = send_request(host, request)
-    match = re.search('document.external_data_post_cls.client_data.value = \"([\w=]+)\"', result)
+    match = _RE_CLIENT_DATA1.search(result)
     if match:
         return match.group(1)
 
-    match = re.search('name="client_data" value="([\w=]+)"', result)
+    match = _RE_CLIENT_DATA2.search(result)
     if match:
         return match.group(1)
     return ''
 
 
-def do_login(host, username, password, dpassword):
-    client_data = get_vpn_client_data(host)
+def do_login(host, username, password, dpassword, client_data=None):
+    if client_data is None:
+        client_data = get_vpn_client_data(host)
 
     body = "rsa_port=&vhost=standard&username=%(user)s&password=%(password)s&dpassword=%(dpassword)s&client_data=%(client_data)s&login=Logon&state=&mrhlogonform=1&miniui=1&tzoffsetmin=1&sessContentType=HTML&overpass=&lang=en&charset=iso-8859-1&uilang=en&uicharset=iso-8859-1&uilangchar=en.iso-8859-1&langswitcher=" % dict(
         user=username, password=password, dpassword=dpassword, client_data=client_data)
 
-    request = """POST /my.activation.php3 HTTP/1.0\r
-Accept: */*\r
-Accept-Language: en\r
-Cookie: VHOST=standard; uRoamTestCookie=TEST\r
-Content-Type: application/x-www-form-urlencoded\r
-Referer: https://%(host)s/my.activation.php3\r
-User-Agent: Mozilla/5.0 (Macintosh; U; PPC Mac OS X; en) AppleWebKit/417.9 (KHTML, like Gecko) Safari/417.9.2\r
-Host: %(host)s\r
-Content-Length: %(len)d\r
-\r
-%(body)s
-""" % dict(host=host, len=len(body), body=body)
+    request = make_request(host, 'POST', '/my.activation.php3',
+                           'VHOST=standard; uRoamTestCookie=TEST', '/my.activation.php3', body=body)
 
     result = send_request(host, request)
 
     session = None
-    pat = re.compile('^Set-Cookie: MRHSession=([^;]*);', re.MULTILINE)
-    for match in pat.finditer(result):
+    for match in _RE_SESSION.finditer(result):
         sessid = match.group(1)
         if sessid == "deleted":
             session = None
@@ -503,7 +791,7 @@ Content-Length: %(len)d\r
             sys.exit(3)
             return None
 
-        match = re.search("(Challenge: [^<]*)", result)
+        match = _RE_CHALLENGE.search(result)
         if match:
             sys.stderr.write(match.group(1) + "\n")
             return None
@@ -518,18 +806,11 @@ Content-Length: %(len)d\r
 
 def get_vpn_menu_number(host, session):
     # Find out the "Z" parameter to use to open a VPN connection
-    request = """GET /vdesk/vpn/index.php3?outform=xml HTTP/1.0\r
-Accept: */*\r
-Accept-Language: en\r
-Cookie: uRoamTestCookie=TEST; VHOST=standard; MRHSession=%(session)s\r
-Referer: https://%(host)s/my.activation.php3\r
-User-Agent: Mozilla/5.0 (Macintosh; U; PPC Mac OS X; en) AppleWebKit/417.9 (KHTML, like Gecko) Safari/417.9.2\r
-Host: %(host)s\r
-\r
-""" % dict(host=host, session=session)
+    request = make_request(host, 'GET', '/vdesk/vpn/index.php3?outform=xml',
+                           'uRoamTestCookie=TEST; VHOST=standard; MRHSession=%s' % session, '/my.activation.php3')
     result = send_request(host, request)
 
-    if re.search('HTTP/[0-9.]+ 302( Found)?', result):
+    if _RE_HTTP_302.search(result):
         # a redirect to the login page.
         sys.stderr.write("Old session no longer valid.\n")
         return None
@@ -540,15 +821,14 @@ Host: %(host)s\r
     if len(favxmlstr) == 0:
         raise NameError("Invalid response getting VPN connection list")
 
-    from xml.dom import minidom
-    xmldoc = minidom.parseString(favxmlstr)
+    root = ElementTree.fromstring(favxmlstr)
 
     # parse the xml return and build datastructure of the options
     favs = []
-    for favxml in xmldoc.getElementsByTagName('favorite'):
-        name = favxml.getElementsByTagName('name')[0].firstChild.wholeText
-        favid = favxml.attributes['id'].value
-        z_matches = re.search('Z=(\S+,\S+)&', favid)
+    for favxml in root.iter('favorite'):
+        name = favxml.find('.//name').text
+        favid = favxml.get('id')
+        z_matches = _RE_Z_PARAM.search(favid)
         if z_matches is not None:
             favid = z_matches.group(1)
 
@@ -577,34 +857,29 @@ Host: %(host)s\r
 
 
 def get_VPN_params(host, session, menu_number):
-    request = """GET /vdesk/vpn/connect.php3?resourcename=%(menu_number)s&outform=xml&client_version=1.1 HTTP/1.0\r
-Accept: */*\r
-Accept-Language: en\r
-Cookie: uRoamTestCookie=TEST; VHOST=standard; MRHSession=%(session)s\r
-Referer: https://%(host)s/vdesk/index.php3\r
-User-Agent: Mozilla/5.0 (Macintosh; U; PPC Mac OS X; en) AppleWebKit/417.9 (KHTML, like Gecko) Safari/417.9.2\r
-Host: %(host)s\r
-\r
-""" % dict(menu_number=menu_number, session=session, host=host)
+    # This is the last request of the login, so let the server close the
+    # connection rather than leaving it idle in _conn_cache.
+    request = make_request(host, 'GET', '/vdesk/vpn/connect.php3?resourcename=%s&outform=xml&client_version=1.1' % menu_number,
+                           'uRoamTestCookie=TEST; VHOST=standard; MRHSession=%s' % session, '/vdesk/index.php3',
+                           connection='close')
     result = send_request(host, request)
     # print "RESULT:", result
 
     # Try to find the plugin parameters
-    matches = list(re.finditer("<embed [^>]*?(version=[^>]*)>", result))
+    matches = list(_RE_EMBED.finditer(result))
     if not matches:
         # A new version of the server has switched to using javascript to write
         # the parameters, now, so try matching that too.
-        matches = list(re.finditer("document.writeln\('(version=[^)]*)'\)", result))
+        matches = list(_RE_EMBED_JS.finditer(result))
 
     if not matches:
-        xml_match = re.search(pattern=r'<\?xml.*<favorite.*<object\s+ID="ur_Host".+?</favorite>', string=result,
-                              flags=re.DOTALL)
+        xml_match = _RE_XML_FAV.search(result)
         if xml_match is not None:
             paramsDict = decode_xml_params(xml_match.group(0))
             return paramsDict
 
     if not matches:
-        if re.search('^Location: /my.logon.php3', result):
+        if _RE_LOCATION_LOGIN.search(result):
             # a redirect to the login page.
             sys.stderr.write("Old session no longer valid.\n")
             return None
@@ -622,16 +897,13 @@ Host: %(host)s\r
 
 def decode_xml_params(xml_param_str):
     paramsDict = {}
-    from xml.dom.minidom import parseString, Element
-    xmldoc = parseString(xml_param_str)
-    for element in xmldoc.getElementsByTagName('object')[0].childNodes:
-        if not isinstance(element, Element):
-            continue
-        if element.firstChild is None:
+    root = ElementTree.fromstring(xml_param_str)
+    for element in next(root.iter('object')):
+        if element.text is None:
             value = ''
         else:
-            value = element.firstChild.wholeText.strip(string.whitespace)
-        paramsDict[element.tagName] = value
+            value = element.text.strip(string.whitespace)
+        paramsDict[element.tag] = value
 
     return paramsDict
 
@@ -642,8 +914,8 @@ def decode_params(paramsStr):
         if param == '':
             continue
         k, v = param.split('=', 1)
-        if re.match('q[0-9]+', k):
-            k, v = v.decode('hex').split('=', 1)
+        if _RE_Q_PARAM.match(k):
+            k, v = bytes.fromhex(v).decode('utf-8').split('=', 1)
         paramsDict[k] = v
 
     return paramsDict
@@ -653,42 +925,54 @@ class LogWatcher:
     """Collect (iface_name, tty, local_ip, remote_ip) from the ppp log messages
     and call ppp_ip_up when they've all arrived."""
 
-    collected_log = ''
+    # The log is kept as raw bytes; only the matched fields get decoded.
+    _RE_IFACE = re.compile(rb"Using interface (.*)$", re.MULTILINE)
+    _RE_TTY = re.compile(rb"Connect: .* <--> (.*)$", re.MULTILINE)
+    _RE_REMOTE_IP = re.compile(rb"remote IP address (.*)$", re.MULTILINE)
+    _RE_LOCAL_IP = re.compile(rb"local  IP address (.*)$", re.MULTILINE)
+
+    collected_log = b''
     iface_name = tty = remote_ip = local_ip = None
     notified = False
 
     def __init__(self, ip_up):
         self.ip_up = ip_up
 
-    def _get_match(self, exp):
-        match = re.search(exp, self.collected_log, re.MULTILINE)
+    def _get_match(self, pat):
+        match = pat.search(self.collected_log)
         if match is not None:
-            return match.group(1)
+            return match.group(1).decode('utf-8')
 
     def process(self, logmsg):
         print("PPPD LOG: %r" % logmsg)
 
+        # Everything we're looking for has been seen; don't keep the log around.
+        if self.notified:
+            return
+
         self.collected_log += logmsg
 
         if self.iface_name is None:
-            self.iface_name = self._get_match("Using interface (.*)$")
+            self.iface_name = self._get_match(self._RE_IFACE)
         if self.tty is None:
-            self.tty = self._get_match("Connect: .* <--> (.*)$")
+            self.tty = self._get_match(self._RE_TTY)
         if self.remote_ip is None:
-            self.remote_ip = self._get_match("remote IP address (.*)$")
+            self.remote_ip = self._get_match(self._RE_REMOTE_IP)
         if self.local_ip is None:
-            self.local_ip = self._get_match("local  IP address (.*)$")
+            self.local_ip = self._get_match(self._RE_LOCAL_IP)
 
-        if not (self.notified or
-                self.iface_name is None or self.tty is None or
+        if not (self.iface_name is None or self.tty is None or
                 self.remote_ip is None or self.local_ip is None):
             print("CALLING ip_up%r" % ((self.iface_name, self.tty, self.local_ip, self.remote_ip),))
             self.notified = True
+            self.collected_log = b''
             self.ip_up(self.iface_name, self.tty, self.local_ip, self.remote_ip)
 
 
 keepalive_socket = None
 
+KEEPALIVE_MSG = b'keepalive'
+
 
 def set_keepalive_host(host):
     global keepalive_socket
@@ -705,61 +989,90 @@ def run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up):
     # Tiny little event-loop: don't try this at home.
     ssl_write_blocked_on_read = False
     ssl_read_blocked_on_write = False
-    data_to_pppd = ''
+    data_to_pppd = b''
     data_to_ssl = ''
     data_to_ssl_buf2 = ''
 
     def sigusr1(sig, frame):
         sys.stderr.write(
             "ssl_write_blocked_on_read=%r, ssl_read_blocked_on_write=%r, data_to_pppd=%r, data_to_ssl=%r, data_to_ssl_buf2=%r, time_since_last_activity=%r\n" % (
-                ssl_write_blocked_on_read, ssl_read_blocked_on_write, data_to_pppd, data_to_ssl, data_to_ssl_buf2,
-                time.time() - last_activity_time))
+                ssl_write_blocked_on_read, ssl_read_blocked_on_write, bytes(data_to_pppd), data_to_ssl, data_to_ssl_buf2,
+                time.monotonic() - (next_keepalive - KEEPALIVE_TIMEOUT)))
 
     signal.signal(signal.SIGUSR1, sigusr1)
 
     logwatcher = LogWatcher(ppp_ip_up)
 
-    last_activity_time = time.time()
+    # Keepalive deadline. SSL traffic only sets ssl_activity; the clock is read
+    # once per iteration, and only when there is a keepalive socket at all.
+    next_keepalive = time.monotonic() + KEEPALIVE_TIMEOUT
+    ssl_activity = False
+
+    # Keep fds registered, and only touch the interest masks when they change
+    sel = selectors.DefaultSelector()
+    sel.register(logpipe_r, selectors.EVENT_READ)
+    sel_pid = os.getpid()
+    masks = {}
 
     while 1:
-        reads = [logpipe_r]
-        writes = []
+        pppd_mask = 0
+        ssl_mask = 0
         # try to write data to pppd if pending, otherwise read more data from ssl
         if data_to_pppd:
-            writes.append(pppd_fd)
+            pppd_mask |= selectors.EVENT_WRITE
         else:
             if ssl_read_blocked_on_write:
-                writes.append(ssl_socket)
+                ssl_mask |= selectors.EVENT_WRITE
             else:
-                reads.append(ssl_socket)
+                ssl_mask |= selectors.EVENT_READ
 
         # Conversely, write data to ssl if pending, otherwise read more data from pppd
         if data_to_ssl:
             if ssl_write_blocked_on_read:
-                reads.append(ssl_socket)
+                ssl_mask |= selectors.EVENT_READ
             else:
-                writes.append(ssl_socket)
+                ssl_mask |= selectors.EVENT_WRITE
         else:
-            reads.append(pppd_fd)
+            pppd_mask |= selectors.EVENT_READ
+
+        # A mask of 0 means "not interested": selectors won't take that (kqueue
+        # re-registers on modify), so such fds are unregistered until needed.
+        for fileobj, mask in ((pppd_fd, pppd_mask), (ssl_socket, ssl_mask)):
+            if not mask:
+                if fileobj in masks:
+                    sel.unregister(fileobj)
+                    del masks[fileobj]
+                continue
+            if fileobj not in masks:
+                sel.register(fileobj, mask)
+            elif masks[fileobj] != mask:
+                sel.modify(fileobj, mask)
+            masks[fileobj] = mask
 
         if keepalive_socket:
-            timeout = max(last_activity_time + KEEPALIVE_TIMEOUT - time.time(), 0)
+            now = time.monotonic()
+            if ssl_activity:
+                next_keepalive = now + KEEPALIVE_TIMEOUT
+                ssl_activity = False
+            timeout = max(next_keepalive - now, 0)
         else:
             timeout = None
 
         # Run the select, woot
         try:
-            reads, writes, exc = select.select(reads, writes, [], timeout)
-        except select.error as se:
+            events = sel.select(timeout)
+        except OSError as se:
             if se.args[0] not in (errno.EAGAIN, errno.EINTR):
                 raise
             continue  # loop back around to try again
 
-        if keepalive_socket and not reads and not writes:
+        if keepalive_socket and not events:
             # Returned from select because of timeout (probably)
-            if time.time() - last_activity_time > KEEPALIVE_TIMEOUT:
+            now = time.monotonic()
+            if now >= next_keepalive:
                 sys.stderr.write("Sending keepalive\n")
-                keepalive_socket.send('keepalive')
+                keepalive_socket.send(KEEPALIVE_MSG)
+                next_keepalive = now + KEEPALIVE_TIMEOUT
 
         # print "SELECT GOT:", reads,writes,exc
 
@@ -768,11 +1081,23 @@ def run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up):
 
         # Read data from log pipe
         try:
-            logmsg = os.read(logpipe_r, BUF_SIZE).decode('utf-8')
+            logmsg = os.read(logpipe_r, BUF_SIZE)
             if not logmsg:  # EOF
                 print("EOF on logpipe_r")
                 break
             logwatcher.process(logmsg)
+            if os.getpid() != sel_pid:
+                # ppp_ip_up forked and this is the child: an epoll instance is
+                # shared with the parent across fork (and a kqueue one isn't
+                # usable at all), so leave it alone and start a fresh one.
+                try:
+                    sel.close()
+                except OSError:
+                    pass
+                sel = selectors.DefaultSelector()
+                sel.register(logpipe_r, selectors.EVENT_READ)
+                sel_pid = os.getpid()
+                masks = {}
         except OSError as se:
             if se.args[0] not in (errno.EAGAIN, errno.EINTR):
                 raise
@@ -793,11 +1118,12 @@ def run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up):
         if not data_to_pppd:
             try:
                 ssl_read_blocked_on_write = False
-                data_to_pppd = ssl_socket.read(BUF_SIZE)
+                # A memoryview, so partial writes to pppd below don't copy the tail
+                data_to_pppd = memoryview(ssl_socket.read(BUF_SIZE))
                 if not data_to_pppd:  # EOF
                     print("EOF on ssl")
                     break
-                last_activity_time = time.time()
+                ssl_activity = True
             except ssl.SSLError as se:
                 if se.args[0] == ssl.SSL_ERROR_WANT_READ:
                     pass
@@ -811,7 +1137,7 @@ def run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up):
         if data_to_pppd:
             try:
                 num_written = os.write(pppd_fd, data_to_pppd)
-                # print "WROTE PPPD: %r" % data_to_pppd[:num_written]
+                # print "WROTE PPPD: %r" % bytes(data_to_pppd[:num_written])
                 data_to_pppd = data_to_pppd[num_written:]
             except OSError as se:
                 if se.args[0] not in (errno.EAGAIN, errno.EINTR):
@@ -832,7 +1158,7 @@ def run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up):
                 # should always either write all data, or raise a WANT_*
                 assert num_written == len(data_to_ssl_buf2)
                 data_to_ssl_buf2 = ''
-                last_activity_time = time.time()
+                ssl_activity = True
             except ssl.SSLError as se:
                 if se.args[0] == ssl.SSL_ERROR_WANT_READ:
                     ssl_write_blocked_on_read = True
@@ -842,6 +1168,8 @@ def run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up):
                     raise
             # print "WROTE SSL: %r" % data_to_ssl[:num_written]
 
+    sel.close()
+
 
 def shutdown_pppd(pid):
     res_pid, result = os.waitpid(pid, os.WNOHANG)
@@ -853,9 +1181,27 @@ def shutdown_pppd(pid):
         os.waitpid(pid, 0)
 
 
-mask2bits = {}
-for x in range(33):
-    mask2bits[2 ** 32 - 2 ** (32 - x)] = x
+def parse_dotted(s):
+    # Parse a possibly short dotted quad (w[.x[.y[.z]]]) into a 32-bit int,
+    # treating missing trailing octets as 0. Octets are always decimal, even
+    # with a leading zero (inet_aton would read 010 as octal 8).
+    octets = s.split('.')
+    n = 0
+    for o in octets:
+        o = int(o)
+        if o > 255:
+            raise ValueError("octet out of range: %d" % o)
+        n = (n << 8) | o
+    return n << (8 * (4 - len(octets)))
+
+
+def netmask_to_bits(netmask):
+    # The host part of a contiguous netmask is all ones ((1 << n) - 1), so adding
+    # one clears it; anything left over means a hole such as 255.0.255.0.
+    inv = ~netmask & 0xFFFFFFFF
+    if inv & (inv + 1):
+        return None
+    return 32 - inv.bit_length()
 
 
 def parse_net_bits(routespec):
@@ -863,69 +1209,104 @@ def parse_net_bits(routespec):
     # w.x.y.z/numbits
     # w.x.y.z/A.B.C.D
     # w[.x[.y[.z]]] (netmask implicit in number of .s)
-    if '/' in routespec:
-        net, bits = routespec.split('/', 1)
-        netparts = list(map(int, net.split('.')))
-        while len(netparts) < 4:
-            netparts.append(0)
-
-        if '.' in bits:
-            netmaskparts = list(map(int, bits.split('.')))
-            netmask = 0
-            for n in netmaskparts:
-                netmask = netmask * 256 + n
-            netmask *= 256 ** (4 - len(netmaskparts))
-
-            bits = mask2bits.get(netmask)
-            if bits is None:
-                raise Exception("Non-contiguous netmask in routespec: %s\n" % (routespec,))
-        else:
-            bits = int(bits)
+    # and returns the network as a 32-bit int, plus the number of bits.
+    m = _RE_ROUTESPEC.match(routespec)
+    if m is None:
+        raise Exception("Invalid routespec: %s\n" % (routespec,))
+
+    net, mask = m.group('net', 'mask')
+    try:
+        net = parse_dotted(net)
+        if mask is not None:
+            mask = parse_dotted(mask)
+    except ValueError:
+        raise Exception("Invalid routespec: %s\n" % (routespec,))
+
+    if mask is not None:
+        bits = netmask_to_bits(mask)
+        if bits is None:
+            raise Exception("Non-contiguous netmask in routespec: %s\n" % (routespec,))
+    elif m.group('bits') is not None:
+        bits = int(m.group('bits'))
     else:
-        netparts = list(map(int, routespec.split('.')))
-        bits = len(netparts) * 8
-        while len(netparts) < 4:
-            netparts.append(0)
+        bits = (m.group('net').count('.') + 1) * 8
 
-    return netparts, bits
+    return net, bits
 
 
-def routespec_to_revdns(netparts, bits):
-    domain = 'in-addr.arpa'
-    i = 0
-    while bits >= 8:
-        domain = str(netparts[i]) + '.' + domain
-        bits -= 8
-        i += 1
+def routespec_to_revdns(net, bits):
+    # Octets fully covered by the prefix name the zone, most significant last
+    i = bits >> 3
+    domain = '.'.join([str((net >> (24 - 8 * j)) & 0xFF) for j in range(i - 1, -1, -1)] + ['in-addr.arpa'])
 
+    bits &= 7
     if bits == 0:
-        return [domain]
+        yield domain
     else:
-        remaining_bits = 8 - bits
-        start_addr = netparts[i] & ~(2 ** remaining_bits - 1)
-        return [(str(n) + '.' + domain)
-                for n in range(start_addr, start_addr + 2 ** (remaining_bits))]
+        span = 1 << (8 - bits)
+        start_addr = ((net >> (24 - 8 * i)) & 0xFF) & -span
+        for n in range(start_addr, start_addr + span):
+            yield f"{n}.{domain}"
+
+
+def get_default_route():
+    """Return (gateway ip, interface name) of the current default route."""
+    if IPRoute is not None and sys.platform == 'linux':
+        # Ask the kernel directly over netlink, rather than forking netstat.
+        # (pyroute2 imports fine elsewhere, but only Linux speaks netlink.)
+        try:
+            with IPRoute() as ipr:
+                routes = ipr.get_default_routes(family=socket.AF_INET)
+                if routes:
+                    route = min(routes, key=lambda r: r.get_attr('RTA_PRIORITY') or 0)
+                    gw_ip = route.get_attr('RTA_GATEWAY')
+                    oif = route.get_attr('RTA_OIF')
+                    if gw_ip is not None and oif is not None:
+                        return gw_ip, ipr.get_links(oif)[0].get_attr('IFLA_IFNAME')
+        except (NetlinkError, OSError) as e:
+            sys.stderr.write("Couldn't get default route over netlink (%s), trying netstat\n" % e)
+
+    out = subprocess.run(['netstat', '-rn'], capture_output=True, text=True).stdout
+    line = next((l for l in out.splitlines() if l.startswith(('default', '0.0.0.0'))), None)
+    if line is None:
+        raise Exception("Couldn't find the default route in netstat -rn output\n")
+    return line.split(None, 2)[1], line.rsplit(None, 1)[-1]
+
+
+# Routes sent through the tunnel with --custom-routes
+CUSTOM_ROUTES = ('100.64.0.0/10', '10.0.0.0/8')
 
 
 def execPPPd(params, skip_dns=False, skip_routes=False, custom_routes=False):
+    if custom_routes and IPRoute is None:
+        raise Exception("--custom-routes needs the pyroute2 module\n")
     tunnel_host = params['tunnel_host0']
     tunnel_port = int(params['tunnel_port0'])
 
     serviceid = "f5vpn-%s" % tunnel_host
 
+    # Parse the routes once up front, ppp_ip_up only has to apply them.
+    # With --skip-routes they aren't looked at at all.
+    params['_LAN0_parsed'] = []
+    if not skip_routes:
+        params['_LAN0_parsed'] = [(net, bits, socket.inet_ntoa(net.to_bytes(4, 'big')))
+                                  for net, bits in map(parse_net_bits, params.get('LAN0', '').split())]
+
     request = """GET /myvpn?sess=%s HTTP/1.0\r
 Cookie: MRHSession=%s\r
 \r
 """ % (params['Session_ID'], params['Session_ID'])
 
+    request = request.encode('utf-8')
+    rcvtimeo = struct.pack('LL', 10, 0)
+
     for i in range(5):
         try:
-            import struct
             unwrapped_socket = proxy_connect(tunnel_host, tunnel_port)
             unwrapped_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
-            unwrapped_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack('LL', 10, 0))
-            ssl_socket = ssl_context.wrap_socket(unwrapped_socket, server_hostname=tunnel_host)
-            ssl_socket.write(request.encode('utf-8'))
+            unwrapped_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, rcvtimeo)
+            ssl_socket = wrap_tls_socket(unwrapped_socket, tunnel_host)
+            ssl_socket.write(request)
             initial_data = ssl_socket.read(1)
             break
         except ssl.SSLError as e:
@@ -934,6 +1315,9 @@ Cookie: MRHSession=%s\r
             if e.args[0] != 8:
                 raise
             sys.stderr.write("VPN socket unexpectedly closed during connection setup, retrying (%d/5)...\n" % (i + 1))
+            # Back off a little so a server that's briefly unhappy gets a chance to recover
+            if i < 4:
+                time.sleep(0.2 * (1 << i))
 
     # Make new PTY
     (pppd_fd, slave_pppd_fd) = os.openpty()
@@ -953,9 +1337,7 @@ Cookie: MRHSession=%s\r
         # the default route.
         tunnel_ip = ssl_socket.getpeername()[0]
 
-        default_route = os.popen("netstat -rn | grep '^default\|^0.0.0.0' | head -n1").read().split()
-        gw_ip = default_route[1]
-        default_interface = default_route[-1]
+        gw_ip, default_interface = get_default_route()
         sys.stderr.write("Detected current default route: %r\n" % gw_ip)
         sys.stderr.write("Attempting to delete and override route to VPN server.\n")
         try:
@@ -964,7 +1346,30 @@ Cookie: MRHSession=%s\r
             pass
         platform.setup_route(default_interface, gw_ip, tunnel_ip, 32, 'add')
 
-    pid = os.fork()
+    # Run pppd
+    args = [PPPD_PATH, 'logfd', '4', 'noauth', 'nodetach',
+            'crtscts', 'passive', 'ipcp-accept-local', 'ipcp-accept-remote',
+            'nodeflate', 'novj', 'local', '+ipv6']
+
+    if override_gateway:
+        args.append('defaultroute')
+    else:
+        args.append('nodefaultroute')
+
+    if sys.platform == "darwin":
+        args.extend(['serviceid', serviceid])
+
+    if os.getuid() == 0:
+        # Same as run_as_root: no point forking the interpreter when the
+        # child doesn't need to change uid. The ssl socket, pty master and
+        # log pipe read end are non-inheritable, so exec closes them.
+        file_actions = [(os.POSIX_SPAWN_DUP2, slave_pppd_fd, 0),
+                        (os.POSIX_SPAWN_DUP2, logpipe_w, 4)]
+        file_actions += [(os.POSIX_SPAWN_CLOSE, fd) for fd in (slave_pppd_fd, logpipe_w) if fd not in (0, 4)]
+        pid = as_root(os.posix_spawn, PPPD_PATH, args, os.environ,
+                      file_actions=file_actions, setsid=True)
+    else:
+        pid = os.fork()
     if pid == 0:
         os.close(ssl_socket.fileno())
         # Setup new controlling TTY
@@ -982,36 +1387,31 @@ Cookie: MRHSession=%s\r
         os.seteuid(0)
         os.setuid(0)
 
-        # Run pppd
-        args = [PPPD_PATH, 'logfd', '4', 'noauth', 'nodetach',
-                'crtscts', 'passive', 'ipcp-accept-local', 'ipcp-accept-remote',
-                'nodeflate', 'novj', 'local', '+ipv6']
-
-        if override_gateway:
-            args.append('defaultroute')
-        else:
-            args.append('nodefaultroute')
-
-        if sys.platform == "darwin":
-            args.extend(['serviceid', serviceid])
-
         try:
             os.execv(PPPD_PATH, args)
         except:
+            os.write(2, ("Couldn't exec %s: %s\n" % (PPPD_PATH, sys.exc_info()[1])).encode('utf-8', 'replace'))
             os._exit(127)
 
     os.close(slave_pppd_fd)
     os.close(logpipe_w)
 
-    def setup_route(iface_name, local_ip, revdns_domains):
-        for routespec in params['LAN0'].split(' '):
-            net, bits = parse_net_bits(routespec)
-            platform.setup_route(iface_name, local_ip, '.'.join(map(str, net)), bits, 'add')
-            revdns_domains.extend(routespec_to_revdns(net, bits))
+    def setup_route(iface_name, local_ip):
+        _setup = platform.setup_route
+        for net, bits, dotted in params['_LAN0_parsed']:
+            _setup(iface_name, local_ip, dotted, bits, 'add')
+        # The reverse DNS zones are generated as setup_dns consumes them
+        return itertools.chain.from_iterable(
+            routespec_to_revdns(net, bits) for net, bits, dotted in params['_LAN0_parsed'])
+
+    dns_servers = params['DNS0'].split(' ') if params.get('DNS0') else []
+    dns_suffixes = params['DNSSuffix0'].split(',') if params.get('DNSSuffix0') else []
+    has_lan0 = bool(params['_LAN0_parsed'])
+    has_dns0 = bool(dns_servers)
 
     def ppp_ip_up(iface_name, tty, local_ip, remote_ip):
-        revdns_domains = []
-        if params.get('LAN0'):
+        revdns_domains = ()
+        if has_lan0:
             if not skip_routes:
                 if getattr(platform, 'wait_for_interface'):
                     pid = os.fork()
@@ -1021,32 +1421,32 @@ Cookie: MRHSession=%s\r
                         os.setuid(0)
 
                         platform.wait_for_interface(iface_name)
-                        setup_route(iface_name, local_ip, revdns_domains)
+                        revdns_domains = setup_route(iface_name, local_ip)
                         os.waitpid(pid, 0)
                 else:
-                    setup_route(iface_name, local_ip, revdns_domains)
+                    revdns_domains = setup_route(iface_name, local_ip)
 
         # sending a packet to the "local" ip appears to actually send data
         # across the connection, which is the desired behavior.
         set_keepalive_host(local_ip)
 
-        if params.get('DNS0') and not skip_dns:
+        if has_dns0 and not skip_dns:
             platform.setup_dns(iface_name, serviceid,
-                               params['DNS0'].split(' '),
-                               params['DNSSuffix0'].split(','), revdns_domains, override_gateway)
+                               dns_servers, dns_suffixes, revdns_domains, override_gateway)
         print("VPN link is up!")
         if custom_routes:
-            from pyroute2 import IPRoute
-            ip = IPRoute()
             print("Adding custom routes..")
-            ip.route("add", dst="100.64.0.0/10", gateway=local_ip, ifname=iface_name)
-            ip.route("add", dst="10.0.0.0/8", gateway=local_ip, ifname=iface_name)
-            ip.close()
+            with IPRoute() as ip:
+                oif = ip.link_lookup(ifname=iface_name)[0]
+                # 'replace' so a reconnect doesn't trip over the routes it
+                # left behind; each call waits for the kernel's ack.
+                for dst in CUSTOM_ROUTES:
+                    ip.route('replace', dst=dst, gateway=local_ip, oif=oif)
 
     try:
         run_event_loop(pppd_fd, ssl_socket, ssl, logpipe_r, ppp_ip_up)
     finally:
-        if params.get('DNS0'):
+        if has_dns0:
             platform.teardown_dns()
         as_root(shutdown_pppd, pid)
         if override_gateway:
@@ -1062,18 +1462,22 @@ def usage(exename, s):
 
 
 def get_prefs():
+    # Returns the dict saved by write_prefs, or None if there isn't a usable one
     try:
-        conf = open(os.path.expanduser(CONFIG_FILE))
-    except:
+        with open(os.path.expanduser(CONFIG_FILE)) as conf:
+            prefs = json.load(conf)
+    except (OSError, ValueError):
         return None
 
-    return conf.readline()
+    if not isinstance(prefs, dict):
+        return None
+    return prefs
 
 
-def write_prefs(line):
+def write_prefs(prefs):
     try:
-        f = open(os.path.expanduser(CONFIG_FILE), 'w')
-        f.write(line)
+        with open(os.path.expanduser(CONFIG_FILE), 'w') as f:
+            json.dump(prefs, f)
     except:
         print("Couldn't write prefs file: %s" % CONFIG_FILE)
 
@@ -1123,7 +1527,9 @@ def main(argv):
     userhost = None
     old_time = None
     if prefs is not None:
-        path, userhost, old_session, old_time = prefs.split('\0')
+        userhost = prefs.get('userhost')
+        old_session = prefs.get('session')
+        old_time = prefs.get('time')
 
     if len(args) > 0:
         if args[0] != userhost:
@@ -1166,7 +1572,7 @@ def main(argv):
     params = None
 
     #check timestamp validation, expire in 1800s
-    if current_time - int(old_time) >= 1 and session is None:
+    if (old_time is None or current_time - old_time >= 1800) and session is None:
         # get new session
         print("Calling f5-utils.py...")
         pass
@@ -1179,10 +1585,20 @@ def main(argv):
             session = old_session
 
     if params is None:
+        # The first login request doesn't depend on the passwords, so get it
+        # (and the TLS handshake) out of the way while the user types them.
+        client_data_future = None
+        if session is None:
+            client_data_future = run_in_background(get_vpn_client_data, host)
+
         while session is None:
             password = getpass.getpass("radius password for %s@%s? " % (user, host))
             dpassword = getpass.getpass("lan password for %s@%s? " % (user, host))
-            session = do_login(host, user, password, dpassword)
+            client_data = None
+            if client_data_future is not None:
+                client_data = client_data_future()
+                client_data_future = None
+            session = do_login(host, user, password, dpassword, client_data)
             if session is not None:
                 print("Session id gotten:", session)
                 break
@@ -1199,7 +1615,7 @@ def main(argv):
         print("Couldn't get embed info. Sorry.")
         sys.exit(2)
 
-    write_prefs('\0'.join(['', userhost, session, str(current_time)]))
+    write_prefs({'userhost': userhost, 'session': session, 'time': current_time})
     print("Got plugin params, execing vpn client")
 
     try: